@@ -0,0 +1,240 @@
+"""
+ボット本体の負荷試験スクリプト。
+
+Discordには接続せず、偽のInteractionを使って PlayerGroup / LeaderboardGroup の
+コマンドを直接呼び出します。Hypixel・Mojang APIはローカルに立てた偽サーバーで代用します。
+多数のサーバーから同時に `/player add` と `/leaderboard refresh` が来た状況を再現し、
+次の値を表示します。
+
+- Interactionの応答時間 (defer から followup まで) の p50 / p99
+- players.json への書き込み回数と、書き込みでイベントループを止めた時間
+- 失われた更新 (成功と返したのに players.json に残っていないプレイヤー)
+
+失われた更新が1件でもあれば終了コード1で終了するので、退行の検出にも使えます。
+
+使い方:
+    python loadtest.py --guilds 300 --adds-per-guild 5
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+# main.py の読み込み前に、APIの接続先を偽サーバーへ向けておく
+FAKE_API_PORT = int(os.getenv("LOADTEST_PORT", 8765))
+os.environ.setdefault("HYPIXEL_API_BASE", f"http://127.0.0.1:{FAKE_API_PORT}")
+os.environ.setdefault("MOJANG_API_BASE", f"http://127.0.0.1:{FAKE_API_PORT}")
+os.environ.setdefault("HYPIXEL_API_KEY", "loadtest")
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# データファイルは相対パスなので、一時ディレクトリで実行して本番のファイルを汚さない
+# (ディレクトリは終了時に削除する)
+WORK_DIR = tempfile.TemporaryDirectory(prefix="hypixel_bot_loadtest_")
+os.chdir(WORK_DIR.name)
+import main  # noqa: E402
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+
+
+# --- 偽のHypixel / Mojang API ---
+def fake_uuid(username: str) -> str:
+    return hashlib.md5(username.lower().encode()).hexdigest()
+
+def build_fake_api(latency: float) -> web.Application:
+    async def profile(request):
+        await asyncio.sleep(latency)
+        name = request.match_info['name']
+        return web.json_response({'id': fake_uuid(name), 'name': name})
+
+    async def bulk_profiles(request):
+        await asyncio.sleep(latency)
+        names = await request.json()
+        return web.json_response([{'id': fake_uuid(n), 'name': n} for n in names])
+
+    async def player(request):
+        await asyncio.sleep(latency)
+        uuid = request.query.get('uuid', '')
+        level = int(uuid[:4], 16) % 3000 if uuid else 0
+        return web.json_response({'success': True, 'player': {'achievements': {'bedwars_level': level}, 'newPackageRank': 'VIP'}})
+
+    app = web.Application()
+    app.router.add_get('/users/profiles/minecraft/{name}', profile)
+    app.router.add_post('/profiles/minecraft', bulk_profiles)
+    app.router.add_get('/player', player)
+    return app
+
+
+# --- 偽のDiscordオブジェクト ---
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.name = f"loadtest-{guild_id}"
+        self.icon = None
+
+class FakeMessage:
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    async def edit(self, **kwargs):
+        self.stats['message_edits'] += 1
+
+class FakeChannel:
+    def __init__(self, channel_id: int, stats: dict):
+        self.id = channel_id
+        self.stats = stats
+
+    def get_partial_message(self, message_id: int):
+        return FakeMessage(self.stats)
+
+class FakeUser:
+    id = 1
+    def __str__(self):
+        return "loadtest-user"
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def defer(self, **kwargs):
+        self.interaction.deferred_at = time.perf_counter()
+
+    async def send_message(self, content=None, **kwargs):
+        self.interaction.record(content)
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        # 1回のコマンドで最初に送ったfollowupまでを応答時間とする
+        if self.interaction.replied_at is None:
+            self.interaction.record(content)
+
+class FakeInteraction:
+    def __init__(self, guild: FakeGuild):
+        self.guild = guild
+        self.user = FakeUser()
+        self.channel = None
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.deferred_at = None
+        self.replied_at = None
+        self.content = None
+
+    def record(self, content):
+        self.replied_at = time.perf_counter()
+        self.content = content
+
+
+# --- 計測 ---
+def instrument_save_data(stats: dict):
+    """main.save_data を包み、ファイルごとの書き込み回数と所要時間を記録します。"""
+    original = main.save_data
+
+    def timed_save_data(data, file_path):
+        started = time.perf_counter()
+        original(data, file_path)
+        stats['writes'].setdefault(file_path, []).append(time.perf_counter() - started)
+
+    main.save_data = timed_save_data
+
+async def run(args) -> int:
+    main.HYPIXEL_REQUEST_INTERVAL_SECONDS = args.request_interval
+    main.EMBED_EDIT_INTERVAL_SECONDS = args.edit_interval
+    main.api_budget.budget = args.api_budget
+    stats = {'writes': {}, 'message_edits': 0}
+    instrument_save_data(stats)
+
+    runner = web.AppRunner(build_fake_api(args.api_latency_ms / 1000))
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', FAKE_API_PORT).start()
+
+    guilds = {1000 + i: FakeGuild(1000 + i) for i in range(args.guilds)}
+    channels = {}
+    for guild_id in guilds:
+        channels[guild_id * 10] = FakeChannel(guild_id * 10, stats)
+        main.leaderboard_registry.add(guild_id, guild_id * 10, guild_id * 100)
+    main.bot.get_guild = guilds.get
+    main.bot.get_channel = channels.get
+    main.job_queue.start()
+
+    player_group = main.PlayerGroup()
+    leaderboard_group = main.LeaderboardGroup()
+
+    async def player_add(guild, username):
+        interaction = FakeInteraction(guild)
+        await main.PlayerGroup.add.callback(player_group, interaction, username)
+        return 'add', guild.id, username, interaction
+
+    async def leaderboard_refresh(guild):
+        interaction = FakeInteraction(guild)
+        await main.LeaderboardGroup.refresh.callback(leaderboard_group, interaction)
+        return 'refresh', guild.id, None, interaction
+
+    calls = []
+    for guild in guilds.values():
+        calls += [player_add(guild, f"lt{guild.id}_{n}") for n in range(args.adds_per_guild)]
+        calls += [leaderboard_refresh(guild) for _ in range(args.refreshes_per_guild)]
+
+    print(f"{args.guilds} サーバーから {len(calls)} 件のコマンドを同時に実行します...")
+    started = time.perf_counter()
+    results = await asyncio.gather(*calls)
+    elapsed = time.perf_counter() - started
+
+    # 残っている更新ジョブが終わるのを待ってから集計する
+    while main.job_queue.pending_count():
+        await asyncio.sleep(0.1)
+    await runner.cleanup()
+
+    latencies = {'add': [], 'refresh': []}
+    succeeded_adds = {}
+    for kind, guild_id, username, interaction in results:
+        if interaction.deferred_at and interaction.replied_at:
+            latencies[kind].append(interaction.replied_at - interaction.deferred_at)
+        if kind == 'add' and interaction.content and interaction.content.startswith("成功"):
+            succeeded_adds.setdefault(str(guild_id), set()).add(username)
+
+    stored = main.load_data(main.PLAYERS_FILE)
+    lost = sum(len(names - {p['username'] for p in stored.get(guild_id, [])}) for guild_id, names in succeeded_adds.items())
+
+    print(f"\n全コマンド完了まで: {elapsed:.2f} 秒")
+    for kind, values in latencies.items():
+        if values:
+            print(f"/{'player add' if kind == 'add' else 'leaderboard refresh'}: {len(values)} 件 "
+                  f"p50={percentile(values, 0.5) * 1000:.1f}ms p99={percentile(values, 0.99) * 1000:.1f}ms")
+    for file_path, durations in sorted(stats['writes'].items()):
+        print(f"{file_path} への書き込み: {len(durations)} 回 合計={sum(durations) * 1000:.1f}ms "
+              f"p99={percentile(durations, 0.99) * 1000:.2f}ms 最大={max(durations) * 1000:.2f}ms")
+    print(f"リーダーボードの編集回数: {stats['message_edits']}")
+    print(f"成功した追加: {sum(len(n) for n in succeeded_adds.values())} 件 / 失われた更新: {lost} 件")
+    return 1 if lost else 0
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="スラッシュコマンドの同時実行に対するボット本体の負荷試験")
+    parser.add_argument("--guilds", type=int, default=200, help="同時にコマンドを送るサーバー数")
+    parser.add_argument("--adds-per-guild", type=int, default=3, help="サーバーごとの /player add の回数")
+    parser.add_argument("--refreshes-per-guild", type=int, default=1, help="サーバーごとの /leaderboard refresh の回数")
+    parser.add_argument("--api-latency-ms", type=float, default=20, help="偽APIサーバーの応答遅延")
+    parser.add_argument("--request-interval", type=float, default=0.0, help="Hypixel APIへのリクエスト間隔(本番は0.6秒)")
+    parser.add_argument("--api-budget", type=int, default=100000, help="Hypixel APIの1分あたりの予算(本番は100)")
+    parser.add_argument("--edit-interval", type=float, default=0.0, help="リーダーボード編集の最短間隔(本番は5秒)")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    try:
+        exit_code = asyncio.run(run(parse_args()))
+    finally:
+        # 削除する前に一時ディレクトリから出ておく
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        WORK_DIR.cleanup()
+    sys.exit(exit_code)
@@ -6,13 +6,73 @@ from aiohttp import web
 import json
 import os
 import asyncio
+import signal
+import time
+import bisect
+import random
+import re
+import codecs
+import shutil
+import heapq
+import itertools
+import io
+import cProfile
+import pstats
+import tracemalloc
+from collections import deque
 from typing import Optional
 from datetime import datetime, timezone, timedelta
 
 # --- 設定 ---
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 HYPIXEL_API_KEY = os.getenv("HYPIXEL_API_KEY")
+# APIの接続先 (負荷試験で偽のサーバーに向けるときだけ環境変数で変更する)
+HYPIXEL_API_BASE = os.getenv("HYPIXEL_API_BASE", "https://api.hypixel.net")
+MOJANG_API_BASE = os.getenv("MOJANG_API_BASE", "https://api.mojang.com")
+# Hypixel APIへのリクエスト間隔(秒)
+HYPIXEL_REQUEST_INTERVAL_SECONDS = 0.6
+# サーバーごとの更新間隔の既定値 (/admin configure で変更できる)
 UPDATE_INTERVAL_MINUTES = 15
+# 更新が必要なサーバーを確認する間隔
+SCHEDULER_TICK_SECONDS = 60
+# Hypixel APIの1分あたりの予算と、1サーバーが使える割合の既定値
+HYPIXEL_API_BUDGET_PER_MINUTE = 100
+DEFAULT_GUILD_API_SHARE = 0.25
+# 予算の使用率がこれを超えたら、各サーバーは公平な取り分までしか使えない
+API_BUDGET_BURST_THRESHOLD = 0.8
+# プレイヤーキャッシュをファイルへ書き出す間隔
+CACHE_SAVE_INTERVAL_MINUTES = 5
+# 起動時にファイルから読み込んだキャッシュを、1ボード・1サイクルあたり何人まで再取得するか
+WARM_REVALIDATE_BATCH_SIZE = 30
+# 更新中のリーダーボードを途中経過で編集する最短間隔 (Discordの編集レート制限対策)
+EMBED_EDIT_INTERVAL_SECONDS = 5
+# リーダーボード1ページあたりの最大人数と、Embedのdescriptionの文字数上限
+LEADERBOARD_PAGE_SIZE = 25
+EMBED_DESCRIPTION_LIMIT = 4096
+# サーキットブレーカー: 連続何回失敗したら遮断するか、遮断時間の基準値と上限(秒)
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_BASE_OPEN_SECONDS = 15
+BREAKER_MAX_OPEN_SECONDS = 600
+# 適応タイムアウト: 直近の応答時間のp95の何倍を待つか、その下限と上限(秒)
+ADAPTIVE_TIMEOUT_MULTIPLIER = 2.0
+ADAPTIVE_TIMEOUT_MIN_SECONDS = 1.5
+ADAPTIVE_TIMEOUT_MAX_SECONDS = 5.0
+# 適応タイムアウトで、p95とは別に最大値を見る直近の件数
+ADAPTIVE_TIMEOUT_RECENT_SAMPLES = 5
+# players.jsonインポート: 読み込み単位、1エントリの最大サイズ、UUID一括解決の1回あたりの件数
+IMPORT_CHUNK_SIZE = 64 * 1024
+IMPORT_MAX_ENTRY_BYTES = 64 * 1024
+MOJANG_BULK_LOOKUP_SIZE = 10
+# UUID解決に使える時間の上限(秒)。Interactionのトークンは15分で失効するので、確認画面を送れるうちに打ち切る
+IMPORT_RESOLVE_TIME_LIMIT_SECONDS = 10 * 60
+# UUID解決の進捗を表示する間隔(秒)
+IMPORT_PROGRESS_INTERVAL_SECONDS = 10
+# 更新ジョブキュー: ワーカー数 (うち1つは常に対話的なジョブ用に空けておく) と優先度
+REFRESH_WORKER_COUNT = 2
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+# ジャーナルへの書き込みをまとめる待ち時間(秒)
+JOURNAL_FLUSH_DELAY_SECONDS = 0.5
 
 # --- ボットの初期設定 ---
 intents = discord.Intents.default()
@@ -22,6 +82,10 @@ bot = commands.Bot(command_prefix='!', intents=intents)
 # --- データファイルのパス ---
 PLAYERS_FILE = 'players.json'
 LEADERBOARDS_FILE = 'leaderboards.json'
+PLAYER_CACHE_FILE = 'player_cache.json'
+JOBS_JOURNAL_FILE = 'jobs_journal.json'
+PROFILE_REPORT_FILE = 'profile_report.txt'
+GUILD_SETTINGS_FILE = 'guild_settings.json'
 
 # --- nest_asyncioの適用 ---
 import nest_asyncio
@@ -36,51 +100,279 @@ def load_data(file_path):
     return {}
 
 def save_data(data, file_path):
-    with open(file_path, 'w', encoding='utf-8') as f:
+    # 書き込み途中で落ちてもファイルが壊れないよう、一時ファイルに書いてから置き換える
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
         json.dump(data, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, file_path)
+
+# players.jsonの読み込み→変更→保存を直列化するロック
+players_lock = asyncio.Lock()
+
+# --- プレイヤーキャッシュ (再起動をまたいで保持) ---
+# uuid -> {'snapshot': 描画用に抜き出したデータ, 'fetched_at': 取得時刻(UNIX秒)}
+BOOT_TIME = time.time()
+_player_cache: Optional[dict] = None
+_player_cache_dirty = False
+
+def get_player_cache() -> dict:
+    """プレイヤーキャッシュを返します。初回アクセス時にファイルから遅延ロードします。"""
+    global _player_cache
+    if _player_cache is None:
+        _player_cache = load_data(PLAYER_CACHE_FILE)
+        print(f"{PLAYER_CACHE_FILE} から {len(_player_cache)} 件のキャッシュを読み込みました。")
+    return _player_cache
+
+def make_player_snapshot(player_data: dict) -> dict:
+    """Hypixelのプレイヤーデータから、リーダーボード描画に必要な項目だけを抜き出します。
+    ランク関連の項目はAPIの応答にあったものだけを残し、元データと同じ形にしておきます。"""
+    snapshot = {'level': player_data.get('achievements', {}).get('bedwars_level', 0)}
+    for key in ('rank', 'monthlyPackageRank', 'newPackageRank', 'packageRank'):
+        if player_data.get(key) is not None:
+            snapshot[key] = player_data[key]
+    return snapshot
+
+def store_player_snapshot(uuid: str, player_data: dict) -> dict:
+    """取得したプレイヤーデータをキャッシュに保存し、スナップショットを返します。"""
+    global _player_cache_dirty
+    snapshot = make_player_snapshot(player_data)
+    get_player_cache()[uuid] = {'snapshot': snapshot, 'fetched_at': time.time()}
+    _player_cache_dirty = True
+    return snapshot
+
+def is_cache_fresh(entry: dict, ttl_seconds: float) -> bool:
+    """キャッシュがttl_seconds(そのサーバーの更新間隔)以内に取得されたものかどうか。"""
+    return time.time() - entry.get('fetched_at', 0) < ttl_seconds
+
+def is_warm_start_entry(entry: dict) -> bool:
+    """起動前にファイルへ保存され、まだこのプロセスで再取得していないキャッシュかどうか。"""
+    return entry.get('fetched_at', 0) < BOOT_TIME
+
+def prune_player_cache() -> int:
+    """どのサーバーのplayers.jsonにも載っていないプレイヤーのキャッシュと描画結果を捨て、捨てた件数を返します。"""
+    global _player_cache_dirty
+    listed = {p.get('uuid') for players in load_data(PLAYERS_FILE).values() for p in players}
+    removed = [uuid for uuid in _player_cache if uuid not in listed]
+    for uuid in removed:
+        del _player_cache[uuid]
+    for uuid in [uuid for uuid in _rendered_lines if uuid not in listed]:
+        del _rendered_lines[uuid]
+    if removed:
+        _player_cache_dirty = True
+    return len(removed)
+
+def save_player_cache(force: bool = False):
+    """登録が外れたプレイヤーを取り除き、変更があればプレイヤーキャッシュをファイルに書き出します。"""
+    global _player_cache_dirty
+    if _player_cache is None:
+        return
+    pruned = prune_player_cache()
+    if pruned:
+        print(f"登録されていないプレイヤー {pruned} 人のキャッシュを削除しました。")
+    if not _player_cache_dirty and not force:
+        return
+    save_data(_player_cache, PLAYER_CACHE_FILE)
+    _player_cache_dirty = False
+    print(f"{PLAYER_CACHE_FILE} に {len(_player_cache)} 件のキャッシュを保存しました。")
+
+# --- リーダーボード登録情報 ---
+class LeaderboardRegistry:
+    """leaderboards.json をメモリ上に保持し、サーバーID・チャンネルID・メッセージIDの
+    どれからでもO(1)で引けるようにした登録簿。変更のたびにファイルへ書き戻します。"""
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._by_guild = None  # guild_id(str) -> {"channel_id", "message_id"}
+        self._by_channel = {}  # channel_id -> guild_id(str)
+        self._by_message = {}  # message_id -> guild_id(str)
+
+    def _ensure_loaded(self):
+        if self._by_guild is None:
+            self._by_guild = {}
+            for guild_id_str, data in load_data(self.file_path).items():
+                self._index(guild_id_str, data)
+
+    def _index(self, guild_id_str: str, data: dict):
+        self._by_guild[guild_id_str] = data
+        self._by_channel[data['channel_id']] = guild_id_str
+        self._by_message[data['message_id']] = guild_id_str
+
+    def _save(self):
+        save_data(self._by_guild, self.file_path)
+
+    def get(self, guild_id: int) -> Optional[dict]:
+        self._ensure_loaded()
+        return self._by_guild.get(str(guild_id))
+
+    def items(self) -> list:
+        self._ensure_loaded()
+        return list(self._by_guild.items())
+
+    def add(self, guild_id: int, channel_id: int, message_id: int):
+        self._ensure_loaded()
+        self.remove(guild_id, save=False)
+        self._index(str(guild_id), {"channel_id": channel_id, "message_id": message_id})
+        self._save()
+
+    def remove(self, guild_id: int, save: bool = True) -> Optional[dict]:
+        self._ensure_loaded()
+        data = self._by_guild.pop(str(guild_id), None)
+        if data:
+            self._by_channel.pop(data['channel_id'], None)
+            self._by_message.pop(data['message_id'], None)
+            if save:
+                self._save()
+        return data
+
+    def remove_by_channel(self, channel_id: int) -> Optional[dict]:
+        self._ensure_loaded()
+        guild_id_str = self._by_channel.get(channel_id)
+        return self.remove(int(guild_id_str)) if guild_id_str else None
+
+    def remove_by_message(self, message_id: int) -> Optional[dict]:
+        self._ensure_loaded()
+        guild_id_str = self._by_message.get(message_id)
+        return self.remove(int(guild_id_str)) if guild_id_str else None
+
+leaderboard_registry = LeaderboardRegistry(LEADERBOARDS_FILE)
+
+async def get_leaderboard_message(guild_id: int) -> Optional[discord.PartialMessage]:
+    """登録済みのリーダーボードのメッセージを組み立てます。通常はキャッシュだけで済み、APIは呼びません。
+    キャッシュに無いチャンネル(起動直後に利用不可のサーバーやスレッドなど)は取得し直し、
+    チャンネルが存在しないと確定した(NotFound)場合だけ登録を削除します。"""
+    data = leaderboard_registry.get(guild_id)
+    if not data:
+        return None
+    channel = bot.get_channel(data['channel_id'])
+    if channel is None:
+        try:
+            channel = await bot.fetch_channel(data['channel_id'])
+        except discord.NotFound:
+            print(f"リーダーボードのチャンネルが見つからないため登録を削除しました: {guild_id}")
+            leaderboard_registry.remove(guild_id)
+            return None
+        except discord.HTTPException as e:
+            print(f"リーダーボードのチャンネルを取得できませんでした: {guild_id} ({e})")
+            return None
+    return channel.get_partial_message(data['message_id'])
+
+# --- サーバーごとの設定とAPI予算 ---
+class GuildSettingsStore:
+    """サーバーごとの更新間隔とAPI予算の割合を guild_settings.json に保存します。"""
+    DEFAULTS = {'interval_minutes': UPDATE_INTERVAL_MINUTES, 'api_share': DEFAULT_GUILD_API_SHARE}
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._data = None
+
+    def get(self, guild_id: int) -> dict:
+        if self._data is None:
+            self._data = load_data(self.file_path)
+        return {**self.DEFAULTS, **self._data.get(str(guild_id), {})}
+
+    def update(self, guild_id: int, **values):
+        self.get(guild_id)
+        self._data.setdefault(str(guild_id), {}).update(values)
+        save_data(self._data, self.file_path)
+
+    def remove(self, guild_id: int):
+        self.get(guild_id)
+        if self._data.pop(str(guild_id), None) is not None:
+            save_data(self._data, self.file_path)
+
+guild_settings = GuildSettingsStore(GUILD_SETTINGS_FILE)
+
+class ApiBudget:
+    """Hypixel APIの1分あたりの予算を、サーバー間で公平に分け合うためのスライディングウィンドウ。
+    各サーバーは自分の割合(api_share)まで使えますが、予算全体が逼迫してきたら
+    直近にAPIを使っているサーバー数で割った公平な取り分までに抑えられます。"""
+    WINDOW_SECONDS = 60
+
+    def __init__(self, budget_per_minute: int):
+        self.budget = budget_per_minute
+        self._all = deque()
+        self._by_guild = {}  # guild_id(str) -> deque[時刻]
+
+    def _expire(self, now: float):
+        while self._all and now - self._all[0][0] >= self.WINDOW_SECONDS:
+            _, guild_key = self._all.popleft()
+            window = self._by_guild.get(guild_key)
+            if window:
+                window.popleft()
+                if not window:
+                    del self._by_guild[guild_key]
+
+    def usage(self, guild_id: Optional[int] = None) -> int:
+        self._expire(time.monotonic())
+        if guild_id is None:
+            return len(self._all)
+        return len(self._by_guild.get(str(guild_id), ()))
+
+    def try_acquire(self, guild_id: Optional[int] = None) -> bool:
+        """1リクエスト分の予算を確保できれば記録してTrueを返します。guild_idがNoneなら全体の予算だけを見ます。"""
+        now = time.monotonic()
+        self._expire(now)
+        used = len(self._all)
+        if used >= self.budget:
+            return False
+        if guild_id is not None:
+            guild_key = str(guild_id)
+            guild_used = len(self._by_guild.get(guild_key, ()))
+            cap = max(1, int(self.budget * guild_settings.get(guild_id)['api_share']))
+            active = len(self._by_guild) + (guild_key not in self._by_guild)
+            fair_share = max(1, self.budget // active)
+            if guild_used >= cap:
+                return False
+            if guild_used >= fair_share and used >= self.budget * API_BUDGET_BURST_THRESHOLD:
+                return False
+        else:
+            guild_key = None
+        self._all.append((now, guild_key))
+        if guild_key is not None:
+            self._by_guild.setdefault(guild_key, deque()).append(now)
+        return True
+
+    def refund(self, guild_id: Optional[int] = None):
+        """try_acquireで確保したのに実際にはリクエストを送らなかった1回分を返却します。"""
+        guild_key = None if guild_id is None else str(guild_id)
+        for i in range(len(self._all) - 1, -1, -1):
+            if self._all[i][1] == guild_key:
+                del self._all[i]
+                break
+        else:
+            return
+        window = self._by_guild.get(guild_key) if guild_key is not None else None
+        if window:
+            window.pop()
+            if not window:
+                del self._by_guild[guild_key]
+
+api_budget = ApiBudget(HYPIXEL_API_BUDGET_PER_MINUTE)
+# 直近の更新でAPI予算を使い切り、一部のプレイヤーをキャッシュのまま表示したサーバー
+budget_exhausted_guilds: set = set()
 
 # --- ヘルパー関数 ---
+# プレステージ記号とランク表記の対応表 (描画のたびに条件分岐をたどらないよう事前に用意しておく)
+PRESTIGE_THRESHOLDS = [1099, 2099, 3099]
+PRESTIGE_ICONS = ["✫", "✪", "⚝", "✥"]
+# 優先度順: スタッフ系のランク → MVP++ → 通常の購入ランク
+# 現在のAPIではスタッフは "STAFF" に統一されている
+SPECIAL_RANK_LABELS = {"STAFF": "[ዞ]", "YOUTUBER": "[YOUTUBE]", "MODERATOR": "[MOD]"}
+PACKAGE_RANK_LABELS = {"MVP_PLUS": "[MVP+]", "MVP": "[MVP]", "VIP_PLUS": "[VIP+]", "VIP": "[VIP]"}
+
 def get_bedwars_prestige(level: int) -> str:
-    if level < 1099: prestige = "✫"
-    elif level < 2099: prestige = "✪"
-    elif level < 3099: prestige = "⚝"
-    else: prestige = "✥"
+    prestige = PRESTIGE_ICONS[bisect.bisect_right(PRESTIGE_THRESHOLDS, level)]
     return f"[{level}{prestige}]"
 
 def format_hypixel_rank(player_data: dict) -> str:
     """Hypixelのプレイヤーデータからランク文字列を生成します。"""
-    rank = player_data.get("rank")
-
-    # ★ 最優先: スタッフランクのチェック
-    # 現在のAPIでは "STAFF" に統一されているため、このチェックだけで十分
-    if rank == "STAFF":
-        return "[ዞ]"
-
-    # 優先度2: Youtuber
-    if rank == "YOUTUBER":
-        return "[YOUTUBE]"
-
-    # 優先度3: Moderator
-    # API上は "MODERATOR" ではなく "MOD" で返ってくる可能性も考慮
-    if rank == "MODERATOR": # 公式のランク名でチェック
-        return "[MOD]"
-
-    # 優先度4: MVP++
+    special = SPECIAL_RANK_LABELS.get(player_data.get("rank"))
+    if special:
+        return special
     if player_data.get("monthlyPackageRank") == "SUPERSTAR":
         return "[MVP++]"
-
-    # 優先度5: 通常の購入ランク
-    package_rank = player_data.get("newPackageRank", player_data.get("packageRank"))
-    if package_rank == "MVP_PLUS":
-        return "[MVP+]"
-    if package_rank == "MVP":
-        return "[MVP]"
-    if package_rank == "VIP_PLUS":
-        return "[VIP+]"
-    if package_rank == "VIP":
-        return "[VIP]"
-        
-    return ""
+    # スナップショットでは newPackageRank が None のまま入っていることがあるので or でたどる
+    package_rank = player_data.get("newPackageRank") or player_data.get("packageRank")
+    return PACKAGE_RANK_LABELS.get(package_rank, "")
 
 JST = timezone(timedelta(hours=+9), 'JST')
 
@@ -88,51 +380,283 @@ def get_jst_now() -> datetime:
     return datetime.now(JST)
 
 # --- Hypixel API & Embed生成ヘルパー ---
-async def get_player_profile(session, username_input: str) -> Optional[dict]:
-    """Mojang APIからUUIDと正確な大文字小文字のユーザー名を取得する"""
-    url = f"https://api.mojang.com/users/profiles/minecraft/{username_input}"
+class CircuitBreaker:
+    """外部APIのエンドポイントごとのサーキットブレーカー。
+    連続して失敗すると一定時間リクエストを遮断(OPEN)し、その間の呼び出しは即座に失敗させます。
+    遮断時間が過ぎると1件だけ試行(HALF_OPEN)し、成功すれば復帰、失敗すれば遮断時間を延ばします。"""
+    CLOSED, OPEN, HALF_OPEN = "CLOSED", "OPEN", "HALF_OPEN"
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self.latencies = deque(maxlen=200)
+        self._probe_in_flight = False
+        # 遮断・復帰のたびに進める世代。これをまたいだリクエストの結果は無視する
+        self._generation = 0
+
+    def allow_request(self) -> Optional[tuple]:
+        """リクエストを送ってよければ (状態の世代, 試行リクエストかどうか) のチケットを、
+        遮断中ならNoneを返します。チケットは結果の記録とend_requestにそのまま渡します。"""
+        if self.state == self.OPEN:
+            if time.monotonic() < self.open_until:
+                return None
+            self.state = self.HALF_OPEN
+            print(f"{self.name}: 遮断時間が経過したため、試行リクエストを送ります。")
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                return None
+            self._probe_in_flight = True
+            return (self._generation, True)
+        return (self._generation, False)
+
+    def timeout(self) -> aiohttp.ClientTimeout:
+        """応答時間のp95と直近数件の最大値のうち大きい方から待ち時間を決めます。
+        APIが遅くなった直後でもすぐに待ち時間が伸びるよう、直近の値も見ています。
+        試行中やデータ不足の間は上限まで待ちます。"""
+        if self.state == self.HALF_OPEN or len(self.latencies) < 20:
+            return aiohttp.ClientTimeout(total=ADAPTIVE_TIMEOUT_MAX_SECONDS)
+        p95 = sorted(self.latencies)[int(len(self.latencies) * 0.95)]
+        recent = max(list(self.latencies)[-ADAPTIVE_TIMEOUT_RECENT_SAMPLES:])
+        total = min(max(max(p95, recent) * ADAPTIVE_TIMEOUT_MULTIPLIER, ADAPTIVE_TIMEOUT_MIN_SECONDS), ADAPTIVE_TIMEOUT_MAX_SECONDS)
+        return aiohttp.ClientTimeout(total=total)
+
+    def _is_stale(self, ticket: tuple) -> bool:
+        # 遮断・復帰をまたいだリクエストの結果は、今の状態の判断には使わない
+        return ticket[0] != self._generation
+
+    def end_request(self, ticket: tuple):
+        """リクエストの終了時に必ず呼びます。試行リクエストがキャンセルや想定外の例外で
+        終わっても、HALF_OPENのまま全リクエストを拒否し続けないようにします。
+        試行枠を空けるのは、そのチケットが試行リクエストだった場合だけです。"""
+        if ticket[1] and not self._is_stale(ticket):
+            self._probe_in_flight = False
+
+    def record_success(self, ticket: tuple, latency: float):
+        self.latencies.append(latency)
+        if self._is_stale(ticket):
+            return
+        self.failures = 0
+        if ticket[1]:
+            self._probe_in_flight = False
+        if self.state != self.CLOSED:
+            print(f"{self.name}: 応答が回復したため、遮断を解除しました。")
+            self.state = self.CLOSED
+            self.trips = 0
+            self._generation += 1
+
+    def record_failure(self, ticket: tuple, retry_after: Optional[float] = None, timed_out_after: Optional[float] = None):
+        # タイムアウトは「少なくともこの時間はかかった」という打ち切られた値として記録し、待ち時間を伸ばす
+        if timed_out_after is not None:
+            self.latencies.append(timed_out_after)
+        # 遮断前に送ったリクエストの失敗で、遮断をやり直して待ち時間を倍にしない
+        if self._is_stale(ticket):
+            return
+        self.failures += 1
+        if ticket[1]:
+            self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= BREAKER_FAILURE_THRESHOLD or retry_after:
+            self._trip(retry_after)
+
+    def _trip(self, retry_after: Optional[float]):
+        # 遮断のたびに待ち時間を倍にし、ジッターで複数の呼び出し元の再試行がそろわないようにする
+        self.trips += 1
+        backoff = min(BREAKER_BASE_OPEN_SECONDS * 2 ** (self.trips - 1), BREAKER_MAX_OPEN_SECONDS)
+        backoff = random.uniform(backoff / 2, backoff)
+        if retry_after:
+            backoff = max(backoff, retry_after)
+        self.state = self.OPEN
+        self._generation += 1
+        self.open_until = time.monotonic() + backoff
+        print(f"{self.name}: 失敗が続いたため {backoff:.0f} 秒間リクエストを遮断します。")
+
+def parse_retry_after(headers, default: float = 60) -> float:
+    """Retry-After(またはRateLimit-Reset)ヘッダーから待機秒数を読み取ります。"""
+    value = headers.get('Retry-After') or headers.get('RateLimit-Reset')
+    try:
+        return float(value) if value else default
+    except ValueError:
+        return default
+
+mojang_breaker = CircuitBreaker("Mojang API")
+hypixel_breaker = CircuitBreaker("Hypixel API")
+
+async def get_player_profile(session, username_input: str):
+    """Mojang APIからUUIDと正確な大文字小文字のユーザー名を取得する。
+    ブレーカーが遮断中の場合は "CIRCUIT_OPEN" を返す"""
+    ticket = mojang_breaker.allow_request()
+    if ticket is None:
+        return "CIRCUIT_OPEN"
+    url = f"{MOJANG_API_BASE}/users/profiles/minecraft/{username_input}"
+    timeout = mojang_breaker.timeout()
+    started = time.monotonic()
     try:
-        # ★ タイムアウトを5秒に設定
-        timeout = aiohttp.ClientTimeout(total=5)
         async with session.get(url, timeout=timeout) as response:
-            if response.status == 200:
-                data = await response.json()
-                if isinstance(data, dict):
-                    return {'uuid': data.get('id'), 'username': data.get('name')}
+            if response.status >= 500:
+                print(f"Mojang APIから予期せぬステータスコード: {response.status}")
+                mojang_breaker.record_failure(ticket)
+                return None
+            if response.status == 429:
+                mojang_breaker.record_failure(ticket, retry_after=parse_retry_after(response.headers))
+                return None
+            data = await response.json() if response.status == 200 else None
+            # 存在しないユーザー名(204/404)もAPI自体は正常に応答している
+            mojang_breaker.record_success(ticket, time.monotonic() - started)
+            if isinstance(data, dict):
+                return {'uuid': data.get('id'), 'username': data.get('name')}
     except asyncio.TimeoutError:
         print(f"Mojang APIへのリクエストがタイムアウトしました: {username_input}")
-    except Exception as e:
+        mojang_breaker.record_failure(ticket, timed_out_after=timeout.total)
+    except (aiohttp.ClientError, ValueError) as e:
         print(f"Mojang APIへのリクエスト中にエラーが発生しました: {e}")
+        mojang_breaker.record_failure(ticket)
+    finally:
+        mojang_breaker.end_request(ticket)
     return None
 
-async def get_player_data(session, uuid: str) -> Optional[dict]:
-    """Hypixel APIからプレイヤーデータを取得する"""
+async def get_player_profiles_bulk(session, usernames: list):
+    """Mojang APIで最大10件のユーザー名をまとめてUUIDに解決する。
+    小文字のユーザー名 -> {'uuid', 'username'} の辞書を返し、失敗時は None、遮断中は "CIRCUIT_OPEN" を返す"""
+    ticket = mojang_breaker.allow_request()
+    if ticket is None:
+        return "CIRCUIT_OPEN"
+    url = f"{MOJANG_API_BASE}/profiles/minecraft"
+    timeout = mojang_breaker.timeout()
+    started = time.monotonic()
+    try:
+        async with session.post(url, json=usernames, timeout=timeout) as response:
+            if response.status == 200:
+                data = await response.json()
+                mojang_breaker.record_success(ticket, time.monotonic() - started)
+                if isinstance(data, list):
+                    return {p['name'].lower(): {'uuid': p['id'], 'username': p['name']}
+                            for p in data if isinstance(p, dict) and p.get('id') and p.get('name')}
+            elif response.status == 429:
+                mojang_breaker.record_failure(ticket, retry_after=parse_retry_after(response.headers))
+            else:
+                print(f"Mojang APIから予期せぬステータスコード: {response.status}")
+                mojang_breaker.record_failure(ticket)
+    except asyncio.TimeoutError:
+        print(f"Mojang APIへの一括リクエストがタイムアウトしました: {len(usernames)}件")
+        mojang_breaker.record_failure(ticket, timed_out_after=timeout.total)
+    except (aiohttp.ClientError, ValueError) as e:
+        print(f"Mojang APIへの一括リクエスト中にエラーが発生しました: {e}")
+        mojang_breaker.record_failure(ticket)
+    finally:
+        mojang_breaker.end_request(ticket)
+    return None
+
+async def get_player_data(session, uuid: str):
+    """Hypixel APIからプレイヤーデータを取得する。
+    レート制限時は "RATE_LIMITED"、ブレーカーが遮断中の場合は "CIRCUIT_OPEN" を返す"""
     if not uuid: return None
-    url = f"https://api.hypixel.net/player?key={HYPIXEL_API_KEY}&uuid={uuid}"
+    ticket = hypixel_breaker.allow_request()
+    if ticket is None:
+        return "CIRCUIT_OPEN"
+    url = f"{HYPIXEL_API_BASE}/player?key={HYPIXEL_API_KEY}&uuid={uuid}"
+    timeout = hypixel_breaker.timeout()
+    started = time.monotonic()
     try:
-        # ★ タイムアウトを5秒に設定
-        timeout = aiohttp.ClientTimeout(total=5)
         async with session.get(url, timeout=timeout) as response:
             if response.status == 200:
                 data = await response.json()
+                hypixel_breaker.record_success(ticket, time.monotonic() - started)
                 if isinstance(data, dict) and data.get('success'):
                     return data.get('player')
             elif response.status == 429:
-                await asyncio.sleep(60)
+                # 待機はせず、ブレーカーを遮断して以降の呼び出しをキャッシュで済ませる
+                hypixel_breaker.record_failure(ticket, retry_after=parse_retry_after(response.headers))
                 return "RATE_LIMITED"
-            # ★ タイムアウト以外のステータスコードもログに出してみる
+            elif response.status >= 500:
+                print(f"Hypixel APIから予期せぬステータスコード: {response.status}")
+                hypixel_breaker.record_failure(ticket)
             else:
                 print(f"Hypixel APIから予期せぬステータスコード: {response.status}")
+                hypixel_breaker.record_success(ticket, time.monotonic() - started)
     except asyncio.TimeoutError:
         print(f"Hypixel APIへのリクエストがタイムアウトしました: {uuid}")
-    except Exception as e:
+        hypixel_breaker.record_failure(ticket, timed_out_after=timeout.total)
+    except (aiohttp.ClientError, ValueError) as e:
         print(f"Hypixel APIへのリクエスト中にエラーが発生しました: {e}")
+        hypixel_breaker.record_failure(ticket)
+    finally:
+        hypixel_breaker.end_request(ticket)
     return None
 
-async def generate_leaderboard_embed(guild: discord.Guild):
-    all_players = load_data(PLAYERS_FILE)
-    player_list = all_players.get(str(guild.id), [])
+def make_leaderboard_entry(uuid: str, username: str, cache_entry: dict) -> dict:
+    """キャッシュのスナップショットから、順位付けと描画に使うエントリを作ります。
+    version には取得時刻を使い、描画結果のキャッシュの鍵にします。"""
+    snapshot = cache_entry['snapshot']
+    return {'uuid': uuid, 'username': username, 'level': snapshot['level'], 'data': snapshot, 'version': cache_entry.get('fetched_at')}
+
+# uuid -> ((スナップショットのバージョン, ユーザー名), 順位を除いた1行分の文字列)
+# 同じプレイヤーを表示する全サーバーで使い回す
+_rendered_lines: dict = {}
 
+def render_player_line(entry: dict) -> str:
+    key = (entry.get('version'), entry['username'])
+    cached = _rendered_lines.get(entry.get('uuid'))
+    if cached and cached[0] == key:
+        return cached[1]
+    prestige_str = get_bedwars_prestige(entry['level'])
+    rank_str = format_hypixel_rank(entry['data'])
+    username_display = entry['username'].replace('_', '\\_')
+    line = f"{prestige_str} {rank_str} {username_display}"
+    if entry.get('uuid'):
+        _rendered_lines[entry['uuid']] = (key, line)
+    return line
+
+def format_leaderboard_line(rank_num: int, entry: dict) -> str:
+    return f"**#{rank_num}** {render_player_line(entry)}\n"
+
+class LeaderboardIndex:
+    """1回の更新で得た順位データから、ページ分割済みのテキストと名前検索用の索引を作ります。
+    ページ送りや順位検索はこの索引だけで答え、APIへの再取得は行いません。"""
+    def __init__(self, leaderboard_data: list):
+        ranked = sorted(leaderboard_data, key=lambda x: x['level'], reverse=True)
+        self.total = len(ranked)
+        self.lines = [format_leaderboard_line(i + 1, entry) for i, entry in enumerate(ranked)]
+        self.pages, self._page_starts = self._chunk_pages(self.lines)
+        # (小文字のユーザー名, 順位) を名前順に並べ、bisectで検索する
+        self._names = sorted((entry['username'].lower(), i + 1) for i, entry in enumerate(ranked))
+        self._name_keys = [name for name, _ in self._names]
+        self.built_at = get_jst_now()
+
+    @staticmethod
+    def _chunk_pages(lines: list) -> tuple:
+        """人数と文字数の両方の上限を超えないようにページを区切り、
+        (各ページの文字列, 各ページ先頭の順位) を返します。"""
+        pages, starts, current, length = [], [], [], 0
+        for rank_num, line in enumerate(lines, start=1):
+            if current and (len(current) >= LEADERBOARD_PAGE_SIZE or length + len(line) > EMBED_DESCRIPTION_LIMIT):
+                pages.append("".join(current))
+                current, length = [], 0
+            if not current:
+                starts.append(rank_num)
+            current.append(line)
+            length += len(line)
+        if current:
+            pages.append("".join(current))
+        return pages, starts
+
+    def find_rank(self, username: str) -> Optional[int]:
+        key = username.lower()
+        i = bisect.bisect_left(self._name_keys, key)
+        if i < len(self._name_keys) and self._name_keys[i] == key:
+            return self._names[i][1]
+        return None
+
+    def page_of(self, rank_num: int) -> int:
+        """指定した順位が載っているページ番号(0始まり)を返します。"""
+        return max(bisect.bisect_right(self._page_starts, rank_num) - 1, 0)
+
+# guild_id(str) -> 直近の更新サイクルで作った索引
+leaderboard_indexes: dict = {}
+
+def build_leaderboard_embed(guild: discord.Guild, index: LeaderboardIndex, page: int = 0, progress: Optional[tuple] = None) -> discord.Embed:
+    """索引の指定ページからEmbedを組み立てます。progressが(取得済み, 全体)なら途中経過として表示します。"""
     embed = discord.Embed(
         title=f" Bedwarsレベル リーダーボード | {guild.name}",
         description="サーバーに登録されたプレイヤーのランキングです。",
@@ -140,67 +664,721 @@ async def generate_leaderboard_embed(guild: discord.Guild):
     )
     if guild.icon:
         embed.set_thumbnail(url=guild.icon.url)
-    
+
+    if index.pages:
+        page = min(max(page, 0), len(index.pages) - 1)
+        embed.description = index.pages[page]
+    elif progress:
+        embed.description = "プレイヤーデータを取得しています..."
+    else:
+        embed.description = "リーダーボードのデータを取得できませんでした。"
+
+    if progress:
+        embed.set_footer(text=f"更新中... {progress[0]}/{progress[1]} 人取得済み")
+    else:
+        footer = f"最終更新: {index.built_at.strftime('%Y-%m-%d %H:%M:%S JST')}"
+        if len(index.pages) > 1:
+            footer += f" | ページ {page + 1}/{len(index.pages)} (全{index.total}人)"
+        embed.set_footer(text=footer)
+    return embed
+
+def build_progress_embed(guild: discord.Guild, entries: list, progress: tuple) -> discord.Embed:
+    """更新途中の表示用に、上位1ページ分だけを選んでEmbedを作ります。
+    全員を並べ替える索引は、更新が終わったときに1度だけ作ります。"""
+    top = heapq.nlargest(LEADERBOARD_PAGE_SIZE, entries, key=lambda x: x['level'])
+    return build_leaderboard_embed(guild, LeaderboardIndex(top), progress=progress)
+
+def get_leaderboard_index(guild: discord.Guild) -> LeaderboardIndex:
+    """直近の索引を返します。まだ無ければ(再起動直後など)キャッシュだけから作ります。"""
+    guild_id_str = str(guild.id)
+    if guild_id_str not in leaderboard_indexes:
+        cache = get_player_cache()
+        player_list = load_data(PLAYERS_FILE).get(guild_id_str, [])
+        leaderboard_data = [
+            make_leaderboard_entry(p['uuid'], p.get('username'), cache[p['uuid']])
+            for p in player_list if p.get('uuid') in cache
+        ]
+        leaderboard_indexes[guild_id_str] = LeaderboardIndex(leaderboard_data)
+    return leaderboard_indexes[guild_id_str]
+
+async def generate_leaderboard_embed(guild: discord.Guild):
+    """リーダーボードのEmbedを生成する非同期ジェネレーター。
+    途中経過のEmbedはEMBED_EDIT_INTERVAL_SECONDSに1回までyieldし、最後にyieldしたものが完成版です。"""
+    all_players = load_data(PLAYERS_FILE)
+    player_list = all_players.get(str(guild.id), [])
+
     if not player_list:
+        leaderboard_indexes.pop(str(guild.id), None)
+        embed = build_leaderboard_embed(guild, LeaderboardIndex([]))
         embed.description = "まだプレイヤーが登録されていません。\n`/player add` で登録してください。"
-        embed.set_footer(text=f"最終更新: {get_jst_now().strftime('%Y-%m-%d %H:%M:%S JST')}")
-        return embed
+        yield embed
+        return
 
-    leaderboard_data = []
-    async with aiohttp.ClientSession() as session:
-        for player_info in player_list:
-            uuid = player_info.get('uuid')
-            username = player_info.get('username')
-            player_hypixel_data = await get_player_data(session, uuid)
-            
-            if player_hypixel_data and player_hypixel_data != "RATE_LIMITED":
-                level = player_hypixel_data.get('achievements', {}).get('bedwars_level', 0)
-                leaderboard_data.append({'username': username, 'level': level, 'data': player_hypixel_data})
-            await asyncio.sleep(0.6)
+    budget_exhausted_guilds.discard(str(guild.id))
+    cache = get_player_cache()
+    ttl_seconds = guild_settings.get(guild.id)['interval_minutes'] * 60
+    # 起動前のキャッシュは古い順に少しずつ再取得し、残りはキャッシュのまま表示する
+    warm_stale = sorted(
+        (p.get('uuid') for p in player_list
+         if p.get('uuid') in cache and not is_cache_fresh(cache[p['uuid']], ttl_seconds) and is_warm_start_entry(cache[p['uuid']])),
+        key=lambda u: cache[u].get('fetched_at', 0)
+    )
+    revalidate_now = set(warm_stale[:WARM_REVALIDATE_BATCH_SIZE])
 
-    leaderboard_data.sort(key=lambda x: x['level'], reverse=True)
+    # uuid -> 表示用エントリ。まずは手元のキャッシュ(古いものも含む)で埋めておく
+    entries = {}
+    to_fetch = []
+    for player_info in player_list:
+        uuid = player_info.get('uuid')
+        cached = cache.get(uuid)
+        if cached:
+            entries[uuid] = make_leaderboard_entry(uuid, player_info.get('username'), cached)
+        if not (cached and (is_cache_fresh(cached, ttl_seconds) or (is_warm_start_entry(cached) and uuid not in revalidate_now))):
+            to_fetch.append(player_info)
+    # 予算が尽きて途中で打ち切ることがあるので、未取得のプレイヤー → 古いキャッシュの順に取得する
+    to_fetch.sort(key=lambda p: cache[p['uuid']].get('fetched_at', 0) if p.get('uuid') in cache else -1)
 
-    if not leaderboard_data:
-        embed.description = "リーダーボードのデータを取得できませんでした。"
+    if to_fetch:
+        # 取得前の時点で分かっている順位をすぐに表示する
+        yield build_progress_embed(guild, entries.values(), (0, len(to_fetch)))
+        last_progress = time.monotonic()
+        async with aiohttp.ClientSession() as session:
+            for done, player_info in enumerate(to_fetch, start=1):
+                if not api_budget.try_acquire(guild.id):
+                    # このサーバーの取り分を使い切ったら、残りはキャッシュのまま表示し、
+                    # 予算の枠が空いた後の自動更新で続きを取得する
+                    print(f"{guild.name}: APIの割り当てを使い切ったため、残り {len(to_fetch) - done + 1} 人はキャッシュで表示し、後で続きを取得します。")
+                    budget_exhausted_guilds.add(str(guild.id))
+                    break
+                uuid = player_info.get('uuid')
+                player_hypixel_data = await get_player_data(session, uuid)
+                if player_hypixel_data == "CIRCUIT_OPEN":
+                    # 遮断中はリクエストを送っていないので予算を返し、残りはすぐにキャッシュのまま表示する
+                    api_budget.refund(guild.id)
+                    print(f"{guild.name}: Hypixel APIが遮断中のため、残り {len(to_fetch) - done + 1} 人はキャッシュで表示します。")
+                    break
+                if not uuid:
+                    # UUIDが無い場合もリクエストを送っていないので、確保した予算を返す
+                    api_budget.refund(guild.id)
+                    continue
+                # 取得に失敗した場合は古いキャッシュのまま残す
+                if player_hypixel_data and player_hypixel_data != "RATE_LIMITED":
+                    store_player_snapshot(uuid, player_hypixel_data)
+                    entries[uuid] = make_leaderboard_entry(uuid, player_info.get('username'), cache[uuid])
+                # 途中経過は編集する間隔が空いたときだけ作る
+                if done < len(to_fetch) and time.monotonic() - last_progress >= EMBED_EDIT_INTERVAL_SECONDS:
+                    yield build_progress_embed(guild, entries.values(), (done, len(to_fetch)))
+                    last_progress = time.monotonic()
+                await asyncio.sleep(HYPIXEL_REQUEST_INTERVAL_SECONDS)
+
+    # 完成した順位は索引としてキャッシュし、ページ送りや順位検索に使う
+    index = LeaderboardIndex(list(entries.values()))
+    leaderboard_indexes[str(guild.id)] = index
+    yield build_leaderboard_embed(guild, index)
+
+async def edit_leaderboard_progressively(message: discord.Message, guild: discord.Guild):
+    """generate_leaderboard_embedがyieldした途中経過と完成版で、順にメッセージを編集します。
+    編集の間隔はジェネレーター側でEMBED_EDIT_INTERVAL_SECONDSに1回までに抑えています。"""
+    view = LeaderboardBrowseView()
+    async for embed in generate_leaderboard_embed(guild):
+        await message.edit(embed=embed, view=view)
+
+# --- ページ送り用のView ---
+class LeaderboardPageView(discord.ui.View):
+    """索引のページを前後に送る、実行者にだけ見えるView。"""
+    def __init__(self, guild: discord.Guild, index: LeaderboardIndex, page: int = 0):
+        super().__init__(timeout=300)
+        self.guild = guild
+        self.index = index
+        self.page = page
+        self._update_buttons()
+
+    def _update_buttons(self):
+        self.previous_page.disabled = self.page <= 0
+        self.next_page.disabled = self.page >= len(self.index.pages) - 1
+
+    async def _show(self, interaction: discord.Interaction):
+        self._update_buttons()
+        await interaction.response.edit_message(embed=build_leaderboard_embed(self.guild, self.index, self.page), view=self)
+
+    @discord.ui.button(label="◀ 前へ", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page -= 1
+        await self._show(interaction)
+
+    @discord.ui.button(label="次へ ▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        await self._show(interaction)
+
+class LeaderboardBrowseView(discord.ui.View):
+    """リーダーボード本体に付ける永続View。再起動後もcustom_idでボタンが動作します。"""
+    def __init__(self):
+        super().__init__(timeout=None)
+
+    @discord.ui.button(label="全順位を見る", style=discord.ButtonStyle.primary, custom_id="leaderboard:browse")
+    async def browse(self, interaction: discord.Interaction, button: discord.ui.Button):
+        index = get_leaderboard_index(interaction.guild)
+        if not index.pages:
+            return await interaction.response.send_message("まだ表示できる順位がありません。", ephemeral=True)
+        view = LeaderboardPageView(interaction.guild, index)
+        await interaction.response.send_message(embed=build_leaderboard_embed(interaction.guild, index), view=view, ephemeral=True)
+
+# --- 更新ジョブキュー ---
+class RefreshJob:
+    def __init__(self, kind: str, target: str, priority: int):
+        self.kind = kind
+        self.target = target
+        self.priority = priority
+        self.key = f"{kind}:{target}"
+        self.future = asyncio.get_running_loop().create_future()
+
+class RefreshJobQueue:
+    """「サーバーXのリーダーボード更新」「UUID Yの取得」といったジョブを優先度順に処理するキュー。
+    同じキーのジョブは1つにまとめ、未完了のジョブはジャーナルファイルに残すので、
+    処理中にプロセスが落ちても再起動後にもう一度実行されます (at-least-once)。
+    バックグラウンドのジョブが全ワーカーを占有しないよう、1つは対話的なジョブ用に空けておきます。"""
+    def __init__(self, journal_path: str, worker_count: int):
+        self.journal_path = journal_path
+        self.worker_count = worker_count
+        self._handlers = {}
+        self._heap = []         # (優先度, 投入順, ジョブ)。優先度を上げたジョブは古いエントリを残したまま積み直す
+        self._queued = {}       # key -> 未実行のジョブ
+        self._running = {}      # key -> 実行中のジョブ
+        self._deferred = {}     # key -> 同じキーのジョブが実行中のため待たせているジョブ
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._workers = []
+        self._journal_handle = None
+
+    def register(self, kind: str, handler):
+        self._handlers[kind] = handler
+
+    def start(self):
+        """ジャーナルに残っていたジョブを積み直し、ワーカーを起動します。"""
+        if self._workers:
+            return
+        journal = load_data(self.journal_path)
+        for job in journal.get('jobs', []):
+            self.enqueue(job['kind'], job['target'], job['priority'])
+        if journal.get('jobs'):
+            print(f"{self.journal_path} から {len(journal['jobs'])} 件の未完了ジョブを再投入しました。")
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    def enqueue(self, kind: str, target: str, priority: int = PRIORITY_BACKGROUND) -> asyncio.Future:
+        """ジョブを投入し、完了時にハンドラの戻り値が入るFutureを返します。
+        同じキーのジョブが既に待機中ならそれを(必要なら優先度を上げて)返します。"""
+        key = f"{kind}:{target}"
+        job = self._queued.get(key)
+        if job:
+            if priority < job.priority:
+                job.priority = priority
+                if key not in self._deferred:
+                    heapq.heappush(self._heap, (priority, next(self._seq), job))
+                self._schedule_journal_flush()
+                self._wakeup.set()
+            return job.future
+        job = RefreshJob(kind, str(target), priority)
+        self._queued[key] = job
+        heapq.heappush(self._heap, (priority, next(self._seq), job))
+        self._schedule_journal_flush()
+        self._wakeup.set()
+        return job.future
+
+    def is_pending(self, kind: str, target: str) -> bool:
+        key = f"{kind}:{target}"
+        return key in self._queued or key in self._running
+
+    def pending_count(self) -> int:
+        return len(self._queued) + len(self._running)
+
+    def _take_next(self) -> Optional[RefreshJob]:
+        background_running = sum(1 for j in self._running.values() if j.priority >= PRIORITY_BACKGROUND)
+        while self._heap:
+            priority, _, job = self._heap[0]
+            if self._queued.get(job.key) is not job or priority != job.priority:
+                heapq.heappop(self._heap)  # 優先度を上げる前の古いエントリ
+                continue
+            if job.key in self._running:
+                heapq.heappop(self._heap)
+                self._deferred[job.key] = job
+                continue
+            if priority >= PRIORITY_BACKGROUND and background_running >= self.worker_count - 1:
+                return None
+            heapq.heappop(self._heap)
+            del self._queued[job.key]
+            self._running[job.key] = job
+            return job
+        return None
+
+    async def _worker(self):
+        while True:
+            job = self._take_next()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            try:
+                result = await self._handlers[job.kind](job.target)
+            except Exception as e:
+                print(f"ジョブ {job.key} の実行中に予期せぬエラー: {e}")
+                result = False
+            if not job.future.done():
+                job.future.set_result(result)
+            del self._running[job.key]
+            deferred = self._deferred.pop(job.key, None)
+            if deferred:
+                heapq.heappush(self._heap, (deferred.priority, next(self._seq), deferred))
+            self._schedule_journal_flush()
+            self._wakeup.set()
+
+    def _schedule_journal_flush(self):
+        # 大量投入時に毎回書き込まないよう、少し待ってからまとめて書き出す
+        if self._journal_handle is None:
+            self._journal_handle = asyncio.get_running_loop().call_later(JOURNAL_FLUSH_DELAY_SECONDS, self.flush_journal)
+
+    def flush_journal(self):
+        """待機中・実行中のジョブをジャーナルファイルに書き出します。"""
+        if self._journal_handle is not None:
+            self._journal_handle.cancel()
+            self._journal_handle = None
+        if not self._workers:
+            return  # まだ起動前なら、前回のジャーナルを読み込む前に上書きしない
+        jobs = list(self._running.values()) + list(self._queued.values())
+        save_data({'jobs': [{'kind': j.kind, 'target': j.target, 'priority': j.priority} for j in jobs]}, self.journal_path)
+
+job_queue = RefreshJobQueue(JOBS_JOURNAL_FILE, REFRESH_WORKER_COUNT)
+# guild_id(str) -> 最後にリーダーボードを更新した時刻(UNIX秒)
+guild_last_refreshed: dict = {}
+
+async def refresh_guild_leaderboard(guild_id_str: str) -> bool:
+    """「refresh_guild」ジョブ: サーバーのリーダーボードを最新の状態に更新します。"""
+    # 成否にかかわらず、次の更新は設定された間隔の後にする
+    previous_refresh = guild_last_refreshed.get(guild_id_str, 0)
+    guild_last_refreshed[guild_id_str] = time.time()
+    guild = bot.get_guild(int(guild_id_str))
+    if not guild:
+        leaderboard_registry.remove(int(guild_id_str))
+        return False
+    message = await get_leaderboard_message(guild.id)
+    if not message:
+        return False
+    try:
+        await edit_leaderboard_progressively(message, guild)
+        if guild_id_str in budget_exhausted_guilds:
+            # API予算が足りず一部だけ更新した場合は、次の自動更新の周期で残りを取得する
+            # (予算のウィンドウはその頃には空いている)
+            guild_last_refreshed[guild_id_str] = previous_refresh
+        return True
+    except (discord.NotFound, discord.Forbidden) as e:
+        print(f"リーダーボード更新中にエラー（削除案件）: {guild.name} ({e})")
+        leaderboard_registry.remove(guild.id)
+    except Exception as e:
+        print(f"リーダーボード {guild.name} の更新中に予期せぬエラー: {e}")
+    return False
+
+async def fetch_player_snapshot(uuid: str) -> bool:
+    """「fetch_uuid」ジョブ: プレイヤー1人のデータを取得してキャッシュに入れます。"""
+    if not api_budget.try_acquire():
+        return False
+    async with aiohttp.ClientSession() as session:
+        player_hypixel_data = await get_player_data(session, uuid)
+    if not uuid or player_hypixel_data == "CIRCUIT_OPEN":
+        api_budget.refund()
     else:
-        leaderboard_text = ""
-        for i, data in enumerate(leaderboard_data[:25]):
-            rank_num = i + 1
-            prestige_str = get_bedwars_prestige(data['level'])
-            rank_str = format_hypixel_rank(data['data'])
-            username_display = data['username'].replace('_', '\\_')
-            leaderboard_text += f"**#{rank_num}** {prestige_str} {rank_str} {username_display}\n"
-        embed.description = leaderboard_text
-
-    embed.set_footer(text=f"最終更新: {get_jst_now().strftime('%Y-%m-%d %H:%M:%S JST')}")
-    return embed
+        await asyncio.sleep(HYPIXEL_REQUEST_INTERVAL_SECONDS)
+    if player_hypixel_data and player_hypixel_data not in ("RATE_LIMITED", "CIRCUIT_OPEN"):
+        store_player_snapshot(uuid, player_hypixel_data)
+        return True
+    return False
 
-# --- 自動更新タスク ---
-@tasks.loop(minutes=UPDATE_INTERVAL_MINUTES)
-async def update_all_leaderboards():
-    print("自動更新タスクを開始します...")
-    leaderboards = load_data(LEADERBOARDS_FILE)
-    if not leaderboards: return
-
-    for guild_id_str, data in list(leaderboards.items()):
-        guild = bot.get_guild(int(guild_id_str))
-        if not guild:
-            del leaderboards[guild_id_str]
+job_queue.register("refresh_guild", refresh_guild_leaderboard)
+job_queue.register("fetch_uuid", fetch_player_snapshot)
+
+# --- players.json インポート ---
+class ImportFormatError(ValueError):
+    """アップロードされたplayers.jsonの構造が不正な場合のエラー。"""
+
+class PlayersImportParser:
+    """players.json ({"guild_id": [{"username": ..., "uuid": ...}, ...], ...}) を
+    チャンク単位で受け取り、プレイヤーのエントリを1件ずつ取り出すストリーミングパーサー。
+    ファイル全体をメモリに載せず、処理中のエントリ1件分だけをバッファします。"""
+    _WHITESPACE = re.compile(r'\s*')
+
+    def __init__(self):
+        self._buffer = ""
+        self._offset = 0  # ファイル先頭からの位置(エラー表示用)
+        self._state = "start"
+        self._guild_id = None
+        self._index = 0
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, text: str, final: bool = False) -> list:
+        """テキストを追加し、読み終えたエントリを (guild_id, 位置, 値) のリストで返します。"""
+        self._buffer += text
+        events = []
+        pos = 0
+        buf = self._buffer
+        while True:
+            pos = self._WHITESPACE.match(buf, pos).end()
+            if pos >= len(buf):
+                break
+            char = buf[pos]
+            state = self._state
+            if state == "start":
+                self._expect(char, "{", pos)
+                self._state, pos = "first_key", pos + 1
+            elif state in ("first_key", "key"):
+                if char == "}" and state == "first_key":
+                    self._state, pos = "done", pos + 1
+                    continue
+                decoded = self._decode(buf, pos, final)
+                if decoded is None:
+                    break
+                key, pos = decoded
+                if not isinstance(key, str):
+                    raise ImportFormatError(f"{self._offset + pos}文字目: サーバーIDは文字列である必要があります。")
+                self._guild_id, self._index = key, 0
+                self._state = "colon"
+            elif state == "colon":
+                self._expect(char, ":", pos)
+                self._state, pos = "array", pos + 1
+            elif state == "array":
+                self._expect(char, "[", pos)
+                self._state, pos = "first_element", pos + 1
+            elif state in ("first_element", "element"):
+                if char == "]" and state == "first_element":
+                    events.append((self._guild_id, None, None))  # 空のリストも「このサーバーは0人」として扱う
+                    self._state, pos = "after_array", pos + 1
+                    continue
+                decoded = self._decode(buf, pos, final)
+                if decoded is None:
+                    break
+                value, pos = decoded
+                events.append((self._guild_id, self._index, value))
+                self._index += 1
+                self._state = "after_element"
+            elif state == "after_element":
+                if char == ",":
+                    self._state = "element"
+                elif char == "]":
+                    self._state = "after_array"
+                else:
+                    raise ImportFormatError(f"{self._offset + pos}文字目: `,` か `]` が必要です。")
+                pos += 1
+            elif state == "after_array":
+                if char == ",":
+                    self._state = "key"
+                elif char == "}":
+                    self._state = "done"
+                else:
+                    raise ImportFormatError(f"{self._offset + pos}文字目: `,` か `}}` が必要です。")
+                pos += 1
+            else:
+                raise ImportFormatError(f"{self._offset + pos}文字目: JSONの終わりの後に余分なデータがあります。")
+
+        self._buffer = buf[pos:]
+        self._offset += pos
+        if len(self._buffer) > IMPORT_MAX_ENTRY_BYTES:
+            raise ImportFormatError(f"{self._offset}文字目: エントリが大きすぎるか、JSONが壊れています。")
+        if final and self._state != "done":
+            raise ImportFormatError("ファイルが途中で終わっています。")
+        return events
+
+    def _expect(self, char: str, expected: str, pos: int):
+        if char != expected:
+            raise ImportFormatError(f"{self._offset + pos}文字目: `{expected}` が必要です。")
+
+    def _decode(self, buf: str, pos: int, final: bool):
+        """値を1つ読み取ります。データが足りない可能性があれば None を返して続きを待ちます。"""
+        try:
+            value, end = self._decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if final:
+                raise ImportFormatError(f"{self._offset + pos}文字目: 有効なJSONの値ではありません。")
+            return None
+        # 数値はバッファの末尾で途切れている可能性がある ("1." + "5" など) ので、
+        # 後ろに区切り文字が来るまで確定しない
+        if not final and not isinstance(value, (dict, list, str)):
+            rest = self._WHITESPACE.match(buf, end).end()
+            if rest >= len(buf) or buf[rest] not in ",]}:":
+                return None
+        return value, end
+
+MINECRAFT_USERNAME_PATTERN = re.compile(r'^[A-Za-z0-9_]{1,16}$')
+UUID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+def validate_import_entry(value) -> tuple:
+    """インポートするエントリを検証・正規化し、(エントリ, エラー文) を返します。"""
+    if not isinstance(value, dict):
+        return None, "オブジェクトではありません"
+    username = value.get('username')
+    if not isinstance(username, str) or not MINECRAFT_USERNAME_PATTERN.match(username):
+        return None, f"ユーザー名が不正です ({username!r})"
+    uuid = value.get('uuid')
+    if uuid is not None:
+        if not isinstance(uuid, str) or not UUID_PATTERN.match(uuid.replace('-', '').lower()):
+            return None, f"UUIDが不正です ({uuid!r})"
+        uuid = uuid.replace('-', '').lower()
+    return {'username': username, 'uuid': uuid}, None
+
+class PlayersImport:
+    """アップロードされたplayers.jsonの検証結果と、現在のデータとの差分。"""
+    MAX_LISTED_ERRORS = 5
+
+    def __init__(self):
+        self.data = {}          # guild_id -> [{'username', 'uuid'}, ...]
+        self.errors = []        # (件数が多くなりうるので先頭の数件だけ表示する)
+        self.error_count = 0
+        self.duplicate_count = 0
+        self.unresolved = []
+        self.timed_out = []     # 時間切れでUUIDを解決できなかったユーザー名
+        self.base = {}          # 差分の基準にした現在のplayers.json
+        self.entry_count = 0
+
+    def add_error(self, message: str):
+        self.error_count += 1
+        if len(self.errors) < self.MAX_LISTED_ERRORS:
+            self.errors.append(message)
+
+    def changed_guild_ids(self) -> list:
+        guild_ids = set(self.data) | set(self.base)
+        return [g for g in guild_ids if self.data.get(g, []) != self.base.get(g, [])]
+
+    def summary(self) -> str:
+        lines = [f"**インポート内容の確認 (まだ適用されていません)**",
+                 f"サーバー数: {len(self.data)} / プレイヤー数: {sum(len(p) for p in self.data.values())} (読み込んだエントリ {self.entry_count} 件)"]
+        if self.duplicate_count:
+            lines.append(f"重複により除外: {self.duplicate_count} 件")
+        if self.unresolved:
+            names = ", ".join(f"`{n}`" for n in self.unresolved[:self.MAX_LISTED_ERRORS])
+            lines.append(f"UUIDを解決できず除外: {len(self.unresolved)} 件 ({names}{' ...' if len(self.unresolved) > self.MAX_LISTED_ERRORS else ''})")
+        if self.timed_out:
+            lines.append(f"時間内にUUIDを解決できず除外: {len(self.timed_out)} 件 (適用後、残りを含むファイルを再度アップロードしてください)")
+        if self.error_count:
+            lines.append(f"不正なエントリとして除外: {self.error_count} 件")
+            lines.extend(f"- {e}" for e in self.errors)
+
+        changed = self.changed_guild_ids()
+        lines.append(f"\n**変更のあるサーバー: {len(changed)} 件**")
+        for guild_id in sorted(changed)[:10]:
+            old = {p.get('uuid') for p in self.base.get(guild_id, [])}
+            new = {p['uuid'] for p in self.data.get(guild_id, [])}
+            if guild_id not in self.data:
+                lines.append(f"- `{guild_id}`: サーバーごと削除 (-{len(old)})")
+            else:
+                lines.append(f"- `{guild_id}`: +{len(new - old)} / -{len(old - new)}")
+        if len(changed) > 10:
+            lines.append(f"...ほか {len(changed) - 10} 件")
+        return "\n".join(lines)[:1900]
+
+async def read_players_import(attachment: discord.Attachment, on_progress=None) -> PlayersImport:
+    """添付ファイルをストリーミングで読み込み、検証・重複除去・UUID解決まで行います。
+    on_progress を渡すと、UUID解決中に (解決済み件数, 全体件数) で定期的に呼び出します。"""
+    deadline = time.monotonic() + IMPORT_RESOLVE_TIME_LIMIT_SECONDS
+    result = PlayersImport()
+    parser = PlayersImportParser()
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    seen = {}  # guild_id -> (既出のUUIDの集合, 既出の小文字ユーザー名の集合)
+    missing_uuid = []  # (guild_id, エントリ)
+
+    def accept(guild_id, index, value):
+        if not guild_id.isdigit():
+            result.add_error(f"`{guild_id}`: サーバーIDが数字ではありません")
+            return
+        entries = result.data.setdefault(guild_id, [])
+        if index is None:
+            return
+        result.entry_count += 1
+        entry, error = validate_import_entry(value)
+        if error:
+            result.add_error(f"`{guild_id}` の {index + 1} 件目: {error}")
+            return
+        seen_uuids, seen_names = seen.setdefault(guild_id, (set(), set()))
+        name_key = entry['username'].lower()
+        if (entry['uuid'] and entry['uuid'] in seen_uuids) or name_key in seen_names:
+            result.duplicate_count += 1
+            return
+        seen_names.add(name_key)
+        if entry['uuid']:
+            seen_uuids.add(entry['uuid'])
+            entries.append(entry)
+        else:
+            missing_uuid.append((guild_id, entry))
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(attachment.url) as response:
+            if response.status != 200:
+                raise ImportFormatError(f"添付ファイルをダウンロードできませんでした (ステータスコード {response.status})。")
+            async for chunk in response.content.iter_chunked(IMPORT_CHUNK_SIZE):
+                for event in parser.feed(decoder.decode(chunk)):
+                    accept(*event)
+        for event in parser.feed(decoder.decode(b"", final=True), final=True):
+            accept(*event)
+
+        # UUIDの無いエントリはユーザー名をまとめてMojang APIで解決する
+        names = sorted({entry['username'].lower() for _, entry in missing_uuid})
+        resolved = {}
+        attempted = set()  # Mojang APIが応答した(=存在しなければ未解決として扱ってよい)ユーザー名
+        last_progress = time.monotonic()
+        i = 0
+        while i < len(names) and time.monotonic() < deadline:
+            batch = names[i:i + MOJANG_BULK_LOOKUP_SIZE]
+            profiles = await get_player_profiles_bulk(session, batch)
+            if profiles == "CIRCUIT_OPEN":
+                # 429などで遮断された場合は、中断せずに遮断が明けるまで待って同じバッチを再試行する
+                await asyncio.sleep(min(max(mojang_breaker.open_until - time.monotonic(), 1), max(deadline - time.monotonic(), 0)))
+                continue
+            if profiles is not None:
+                resolved.update(profiles)
+                attempted.update(batch)
+                i += MOJANG_BULK_LOOKUP_SIZE
+            # 失敗(None)した場合も同じバッチを再試行する。失敗が続けばブレーカーが遮断する
+            if on_progress and time.monotonic() - last_progress >= IMPORT_PROGRESS_INTERVAL_SECONDS:
+                last_progress = time.monotonic()
+                await on_progress(min(i, len(names)), len(names))
+            await asyncio.sleep(HYPIXEL_REQUEST_INTERVAL_SECONDS)
+
+    for guild_id, entry in missing_uuid:
+        profile = resolved.get(entry['username'].lower())
+        if not profile:
+            if entry['username'].lower() in attempted:
+                result.unresolved.append(entry['username'])
+            else:
+                result.timed_out.append(entry['username'])
+            continue
+        seen_uuids = seen[guild_id][0]
+        if profile['uuid'] in seen_uuids:
+            result.duplicate_count += 1
             continue
+        seen_uuids.add(profile['uuid'])
+        result.data[guild_id].append({'username': profile['username'], 'uuid': profile['uuid']})
+
+    result.base = load_data(PLAYERS_FILE)
+    return result
+
+class ImportConfirmView(discord.ui.View):
+    """インポート内容の確認後に、適用するかキャンセルするかを選ぶView。"""
+    def __init__(self, players_import: PlayersImport, user: discord.abc.User):
+        super().__init__(timeout=300)
+        self.players_import = players_import
+        self.user = user
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return interaction.user.id == self.user.id
+
+    @discord.ui.button(label="適用する", style=discord.ButtonStyle.danger)
+    async def apply(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.stop()
+        # ロック中は判定と書き込みだけを行い、Discordへの返信はロックを外してから送る
+        async with players_lock:
+            # 確認中に他のコマンドでplayers.jsonが変わっていたら、差分が古いので適用しない
+            conflicted = load_data(PLAYERS_FILE) != self.players_import.base
+            if not conflicted:
+                if os.path.exists(PLAYERS_FILE):
+                    shutil.copyfile(PLAYERS_FILE, PLAYERS_FILE + ".bak")
+                save_data(self.players_import.data, PLAYERS_FILE)
+        if conflicted:
+            return await interaction.response.edit_message(
+                content="エラー: 確認中に `players.json` が変更されたため適用を中止しました。もう一度アップロードしてください。", view=None)
+        changed = self.players_import.changed_guild_ids()
+        await interaction.response.edit_message(
+            content=f"`players.json` のインポートを適用しました。変更のあった {len(changed)} 件のサーバーのリーダーボードを自動更新します。", view=None)
+        print(f"管理者 {interaction.user} によって {PLAYERS_FILE} がインポートされました。")
+        for guild_id_str in changed:
+            leaderboard_indexes.pop(guild_id_str, None)
+            if leaderboard_registry.get(int(guild_id_str)):
+                job_queue.enqueue("refresh_guild", guild_id_str, PRIORITY_INTERACTIVE)
+
+    @discord.ui.button(label="キャンセル", style=discord.ButtonStyle.secondary)
+    async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.stop()
+        await interaction.response.edit_message(content="インポートをキャンセルしました。", view=None)
+
+# --- プロファイリング ---
+class CycleProfiler:
+    """管理者が /admin profile で予約したとき、次の自動更新サイクル1回分を
+    cProfileとtracemallocで計測し、結果をPROFILE_REPORT_FILEに書き出します。"""
+    def __init__(self, report_path: str):
+        self.report_path = report_path
+        self.armed = False
+        self.running = False
+        # イベントループは弱参照しか持たないため、計測タスクの参照をここで保持する
+        self.task = None
+
+    def toggle(self) -> bool:
+        self.armed = not self.armed
+        return self.armed
+
+    def start(self, futures: list):
+        """計測タスクを起動し、終了まで参照を保持します。"""
+        self.task = asyncio.create_task(self.capture(futures))
+        self.task.add_done_callback(self._on_done)
+
+    def _on_done(self, task: asyncio.Task):
+        self.task = None
+        if not task.cancelled() and task.exception():
+            print(f"プロファイルの保存中にエラーが発生しました: {task.exception()}")
+
+    async def capture(self, futures: list):
+        """渡されたジョブがすべて終わるまでの間を計測します。"""
+        self.armed = False
+        self.running = True
+        profiler = cProfile.Profile()
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        started = time.perf_counter()
+        profiler.enable()
         try:
-            channel = await bot.fetch_channel(data['channel_id'])
-            message = await channel.fetch_message(data['message_id'])
-            new_embed = await generate_leaderboard_embed(guild)
-            await message.edit(embed=new_embed)
-        except (discord.NotFound, discord.Forbidden) as e:
-            print(f"リーダーボード更新中にエラー（削除案件）: {guild.name} ({e})")
-            del leaderboards[guild_id_str]
-        except Exception as e:
-            print(f"リーダーボード {guild.name} の更新中に予期せぬエラー: {e}")
-            
-    save_data(leaderboards, LEADERBOARDS_FILE)
-    print("自動更新タスクが完了しました。")
-    
+            # 失敗したジョブがあっても、サイクル全体を計測し終えてからレポートを出す
+            await asyncio.gather(*futures, return_exceptions=True)
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - started
+            memory_snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if started_tracing:
+                tracemalloc.stop()
+            self.running = False
+
+        report = io.StringIO()
+        report.write(f"計測日時: {get_jst_now().strftime('%Y-%m-%d %H:%M:%S JST')}\n")
+        report.write(f"対象ジョブ: {len(futures)} 件 / 所要時間: {elapsed:.2f} 秒 / メモリ使用量のピーク: {peak / 1024:.0f} KiB\n\n")
+        report.write("=== cProfile (累積時間順 上位40件) ===\n")
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(40)
+        report.write("\n=== tracemalloc (確保量の多い行 上位20件) ===\n")
+        for stat in memory_snapshot.statistics('lineno')[:20]:
+            report.write(f"{stat}\n")
+        with open(self.report_path, 'w', encoding='utf-8') as f:
+            f.write(report.getvalue())
+        print(f"自動更新サイクルのプロファイルを {self.report_path} に保存しました。")
+
+cycle_profiler = CycleProfiler(PROFILE_REPORT_FILE)
+
+# --- 自動更新タスク ---
+def is_guild_refresh_due(guild_id_str: str) -> bool:
+    interval_seconds = guild_settings.get(int(guild_id_str))['interval_minutes'] * 60
+    return time.time() - guild_last_refreshed.get(guild_id_str, 0) >= interval_seconds
+
+@tasks.loop(seconds=SCHEDULER_TICK_SECONDS)
+async def update_all_leaderboards():
+    # サーバーごとの更新間隔を過ぎたものだけを投入する。実際の更新はジョブキューのワーカーが行う
+    due = [guild_id_str for guild_id_str, _ in leaderboard_registry.items()
+           if is_guild_refresh_due(guild_id_str) and not job_queue.is_pending("refresh_guild", guild_id_str)]
+    if not due:
+        return
+    print(f"自動更新タスクを開始します... ({len(due)} サーバー)")
+    futures = [job_queue.enqueue("refresh_guild", guild_id_str, PRIORITY_BACKGROUND) for guild_id_str in due]
+    if cycle_profiler.armed:
+        cycle_profiler.start(futures)
+    print(f"自動更新ジョブを投入しました。(待機中・実行中のジョブ: {job_queue.pending_count()}件)")
+
+@tasks.loop(minutes=CACHE_SAVE_INTERVAL_MINUTES)
+async def persist_player_cache():
+    """プレイヤーキャッシュを定期的にファイルへ保存します。"""
+    save_player_cache()
+
 @update_all_leaderboards.error
 async def on_update_all_leaderboards_error(error):
     """自動更新タスクで発生したエラーを捕捉してログに出力します。"""
@@ -218,10 +1396,41 @@ async def on_ready():
     except Exception as e:
         print(f'コマンドの同期に失敗しました: {e}')
     
+    # 再起動前に送信したリーダーボードのボタンも反応するように永続Viewを登録する
+    bot.add_view(LeaderboardBrowseView())
+
+    job_queue.start()
     if not update_all_leaderboards.is_running():
         update_all_leaderboards.start()
+    if not persist_player_cache.is_running():
+        persist_player_cache.start()
     print('------')
 
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    """サーバーから退出したら、そのサーバーのリーダーボード登録を削除します。"""
+    guild_settings.remove(guild.id)
+    if leaderboard_registry.remove(guild.id):
+        print(f"サーバー {guild.name} から退出したため、リーダーボードの登録を削除しました。")
+
+@bot.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    """リーダーボードのあるチャンネルが削除されたら登録を削除します。"""
+    if leaderboard_registry.remove_by_channel(channel.id):
+        print(f"チャンネル {channel.name} が削除されたため、リーダーボードの登録を削除しました。")
+
+@bot.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    """リーダーボードのメッセージが削除されたら登録を削除します。"""
+    if leaderboard_registry.remove_by_message(payload.message_id):
+        print(f"リーダーボードのメッセージが削除されたため、登録を削除しました: {payload.guild_id}")
+
+@bot.event
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    for message_id in payload.message_ids:
+        if leaderboard_registry.remove_by_message(message_id):
+            print(f"リーダーボードのメッセージが一括削除されたため、登録を削除しました: {payload.guild_id}")
+
 # --- スラッシュコマンド ---
 class PlayerGroup(app_commands.Group):
     def __init__(self):
@@ -236,44 +1445,37 @@ class PlayerGroup(app_commands.Group):
         
         async with aiohttp.ClientSession() as session:
             profile = await get_player_profile(session, username)
+            if profile == "CIRCUIT_OPEN":
+                return await interaction.followup.send("エラー: Mojang APIが一時的に利用できません。しばらくしてから再度お試しください。")
             if not profile or not profile.get('uuid'):
                 return await interaction.followup.send(f"エラー: Minecraftプレイヤー `{username}` が見つかりませんでした。")
         
         exact_username = profile['username']
         uuid = profile['uuid']
 
-        all_players = load_data(PLAYERS_FILE)
-        if guild_id_str not in all_players:
-            all_players[guild_id_str] = []
+        # 読み込みから保存までをロックで囲み、同時に実行された追加が失われないようにする
+        # 返信はロックを外してから送り、Discordの応答待ちで他のサーバーの追加・削除を止めない
+        async with players_lock:
+            all_players = load_data(PLAYERS_FILE)
+            if guild_id_str not in all_players:
+                all_players[guild_id_str] = []
 
-        if any(p['uuid'] == uuid for p in all_players[guild_id_str]):
-            return await interaction.followup.send(f"エラー: `{exact_username}` は既に追加されています。")
+            already_added = any(p['uuid'] == uuid for p in all_players[guild_id_str])
+            if not already_added:
+                all_players[guild_id_str].append({'username': exact_username, 'uuid': uuid})
+                save_data(all_players, PLAYERS_FILE)
 
-        all_players[guild_id_str].append({'username': exact_username, 'uuid': uuid})
-        save_data(all_players, PLAYERS_FILE)
+        if already_added:
+            return await interaction.followup.send(f"エラー: `{exact_username}` は既に追加されています。")
         
         # ★★★ ここからが追加・変更部分 ★★★
         await interaction.followup.send(f"成功: `{exact_username}` を追加しました。リーダーボードを自動更新します...", ephemeral=True)
         
         # リーダーボードの自動更新処理を呼び出す
-        leaderboards = load_data(LEADERBOARDS_FILE)
-        if guild_id_str in leaderboards:
-            data = leaderboards[guild_id_str]
-            try:
-                channel = await bot.fetch_channel(data['channel_id'])
-                message = await channel.fetch_message(data['message_id'])
-                
-                # 更新中メッセージを表示（UX向上のため）
-                loading_embed = discord.Embed(title="更新中...", description="プレイヤーリストが変更されたため、リーダーボードを更新しています...", color=discord.Color.blue())
-                await message.edit(embed=loading_embed)
-                
-                # 最新のリーダーボードを生成して更新
-                new_embed = await generate_leaderboard_embed(interaction.guild)
-                await message.edit(embed=new_embed)
-                print(f"{interaction.guild.name} のリーダーボードをプレイヤー追加により自動更新しました。")
-            except Exception as e:
-                print(f"プレイヤー追加後の自動更新中にエラー: {e}")
-                # ここでのエラーはユーザーに通知しない（追加自体は成功しているため）
+        # 追加したプレイヤーのデータを先に取得してから、リーダーボードの更新を依頼する
+        await job_queue.enqueue("fetch_uuid", uuid, PRIORITY_INTERACTIVE)
+        if leaderboard_registry.get(interaction.guild.id):
+            job_queue.enqueue("refresh_guild", guild_id_str, PRIORITY_INTERACTIVE)
 
     @app_commands.command(name="remove", description="リーダーボードからMinecraftプレイヤーを削除します。")
     @app_commands.describe(username="削除するMinecraftのユーザー名")
@@ -281,39 +1483,26 @@ class PlayerGroup(app_commands.Group):
     async def remove(self, interaction: discord.Interaction, username: str):
         await interaction.response.defer(ephemeral=True)
         guild_id_str = str(interaction.guild.id)
-        all_players = load_data(PLAYERS_FILE)
-        player_list = all_players.get(guild_id_str, [])
-        player_to_remove = next((p for p in player_list if p['username'].lower() == username.lower()), None)
-        
+        async with players_lock:
+            all_players = load_data(PLAYERS_FILE)
+            player_list = all_players.get(guild_id_str, [])
+            player_to_remove = next((p for p in player_list if p['username'].lower() == username.lower()), None)
+            
+            if player_to_remove:
+                removed_username = player_to_remove['username'] # 削除される正確な名前を保持
+                player_list.remove(player_to_remove)
+                all_players[guild_id_str] = player_list
+                save_data(all_players, PLAYERS_FILE)
+
         if not player_to_remove:
             return await interaction.followup.send(f"エラー: `{username}` はリストに見つかりませんでした。")
         
-        removed_username = player_to_remove['username'] # 削除される正確な名前を保持
-        player_list.remove(player_to_remove)
-        all_players[guild_id_str] = player_list
-        save_data(all_players, PLAYERS_FILE)
-        
         # ★★★ ここからが追加・変更部分 ★★★
         await interaction.followup.send(f"成功: `{removed_username}` を削除しました。リーダーボードを自動更新します...", ephemeral=True)
 
         # リーダーボードの自動更新処理を呼び出す
-        leaderboards = load_data(LEADERBOARDS_FILE)
-        if guild_id_str in leaderboards:
-            data = leaderboards[guild_id_str]
-            try:
-                channel = await bot.fetch_channel(data['channel_id'])
-                message = await channel.fetch_message(data['message_id'])
-                
-                # 更新中メッセージを表示
-                loading_embed = discord.Embed(title="更新中...", description="プレイヤーリストが変更されたため、リーダーボードを更新しています...", color=discord.Color.blue())
-                await message.edit(embed=loading_embed)
-
-                # 最新のリーダーボードを生成して更新
-                new_embed = await generate_leaderboard_embed(interaction.guild)
-                await message.edit(embed=new_embed)
-                print(f"{interaction.guild.name} のリーダーボードをプレイヤー削除により自動更新しました。")
-            except Exception as e:
-                print(f"プレイヤー削除後の自動更新中にエラー: {e}")
+        if leaderboard_registry.get(interaction.guild.id):
+            job_queue.enqueue("refresh_guild", guild_id_str, PRIORITY_INTERACTIVE)
 
 class LeaderboardGroup(app_commands.Group):
     def __init__(self):
@@ -324,19 +1513,15 @@ class LeaderboardGroup(app_commands.Group):
     async def create(self, interaction: discord.Interaction, channel: Optional[discord.TextChannel] = None):
         await interaction.response.defer(ephemeral=True)
         target_channel = channel or interaction.channel
-        guild_id_str = str(interaction.guild.id)
         
-        leaderboards = load_data(LEADERBOARDS_FILE)
-        if guild_id_str in leaderboards:
+        if leaderboard_registry.get(interaction.guild.id):
             return await interaction.followup.send("エラー: このサーバーには既にリーダーボードが存在します。")
             
         try:
             embed = discord.Embed(title="リーダーボード生成中...", color=discord.Color.blue())
             message = await target_channel.send(embed=embed)
-            leaderboards[guild_id_str] = {"channel_id": target_channel.id, "message_id": message.id}
-            save_data(leaderboards, LEADERBOARDS_FILE)
-            initial_embed = await generate_leaderboard_embed(interaction.guild)
-            await message.edit(embed=initial_embed)
+            leaderboard_registry.add(interaction.guild.id, target_channel.id, message.id)
+            await job_queue.enqueue("refresh_guild", str(interaction.guild.id), PRIORITY_INTERACTIVE)
             await interaction.followup.send(f"成功: {target_channel.mention} にリーダーボードを作成しました。")
         except Exception as e:
             await interaction.followup.send(f"予期せぬエラー: {e}")
@@ -345,43 +1530,47 @@ class LeaderboardGroup(app_commands.Group):
     @app_commands.default_permissions(manage_guild=True)
     async def remove(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True)
-        guild_id_str = str(interaction.guild.id)
-        
-        leaderboards = load_data(LEADERBOARDS_FILE)
-        if guild_id_str not in leaderboards:
+        if not leaderboard_registry.get(interaction.guild.id):
             return await interaction.followup.send("エラー: このサーバーにリーダーボードは作成されていません。")
             
-        data = leaderboards[guild_id_str]
-        try:
-            channel = bot.get_channel(data['channel_id']) or await bot.fetch_channel(data['channel_id'])
-            message = await channel.fetch_message(data['message_id'])
-            await message.delete()
-        except (discord.NotFound, discord.Forbidden):
-            pass
+        message = await get_leaderboard_message(interaction.guild.id)
+        # 先に登録を外しておき、削除イベントで二重に処理されないようにする
+        leaderboard_registry.remove(interaction.guild.id)
+        if message:
+            try:
+                await message.delete()
+            except (discord.NotFound, discord.Forbidden):
+                pass
             
-        del leaderboards[guild_id_str]
-        save_data(leaderboards, LEADERBOARDS_FILE)
         await interaction.followup.send("成功: リーダーボードを削除しました。")
 
     @app_commands.command(name="refresh", description="リーダーボードを手動で最新の状態に更新します。")
     @app_commands.default_permissions(manage_guild=True)
     async def refresh(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True)
-        guild_id_str = str(interaction.guild.id)
-        leaderboards = load_data(LEADERBOARDS_FILE)
-        if guild_id_str not in leaderboards:
+        if not leaderboard_registry.get(interaction.guild.id):
             return await interaction.followup.send("エラー: リーダーボードがありません。")
-        data = leaderboards[guild_id_str]
-        try:
-            channel = await bot.fetch_channel(data['channel_id'])
-            message = await channel.fetch_message(data['message_id'])
-            loading_embed = discord.Embed(title="更新中...", color=discord.Color.blue())
-            await message.edit(embed=loading_embed)
-            new_embed = await generate_leaderboard_embed(interaction.guild)
-            await message.edit(embed=new_embed)
+        # 自動更新のジョブより先に処理される
+        if await job_queue.enqueue("refresh_guild", str(interaction.guild.id), PRIORITY_INTERACTIVE):
             await interaction.followup.send("成功: 更新しました。")
-        except Exception as e:
-            await interaction.followup.send(f"エラー: {e}")
+        else:
+            await interaction.followup.send("エラー: リーダーボードを更新できませんでした。")
+
+    @app_commands.command(name="rank", description="リーダーボード上のプレイヤーの順位を調べます。")
+    @app_commands.describe(player="調べるMinecraftのユーザー名")
+    async def rank(self, interaction: discord.Interaction, player: str):
+        index = get_leaderboard_index(interaction.guild)
+        rank_num = index.find_rank(player)
+        if rank_num is None:
+            return await interaction.response.send_message(f"エラー: `{player}` はリーダーボードに見つかりませんでした。", ephemeral=True)
+        page = index.page_of(rank_num)
+        view = LeaderboardPageView(interaction.guild, index, page)
+        await interaction.response.send_message(
+            f"{index.lines[rank_num - 1].strip()} (全{index.total}人中)",
+            embed=build_leaderboard_embed(interaction.guild, index, page),
+            view=view,
+            ephemeral=True
+        )
 
 class AdminGroup(app_commands.Group):
     def __init__(self):
@@ -391,7 +1580,7 @@ class AdminGroup(app_commands.Group):
     @app_commands.describe(filename="ファイル名 (例: players.json)")
     @app_commands.default_permissions(administrator=True)
     async def getfile(self, interaction: discord.Interaction, filename: str):
-        if filename not in ['players.json', 'leaderboards.json']:
+        if filename not in ['players.json', 'leaderboards.json', PROFILE_REPORT_FILE]:
             return await interaction.response.send_message("エラー: 不正なファイル名です。", ephemeral=True)
         try:
             await interaction.response.send_message(f"`{filename}` を送信します。", file=discord.File(filename), ephemeral=True)
@@ -400,8 +1589,48 @@ class AdminGroup(app_commands.Group):
         except Exception as e:
             await interaction.response.send_message(f"エラーが発生しました: {e}", ephemeral=True)
 
-    ### ★★★ ここからが新しいコマンド ★★★ ###
-    @app_commands.command(name="uploadfile", description="players.jsonをアップロードしてサーバーのデータを上書きします。")
+    @app_commands.command(name="settings", description="このサーバーの更新間隔とAPI予算の設定・使用状況を表示します。")
+    @app_commands.default_permissions(administrator=True)
+    async def settings(self, interaction: discord.Interaction):
+        settings = guild_settings.get(interaction.guild.id)
+        cap = max(1, int(HYPIXEL_API_BUDGET_PER_MINUTE * settings['api_share']))
+        last = guild_last_refreshed.get(str(interaction.guild.id))
+        last_text = datetime.fromtimestamp(last, JST).strftime('%Y-%m-%d %H:%M:%S JST') if last else "未更新"
+        await interaction.response.send_message(
+            f"**{interaction.guild.name} の設定**\n"
+            f"更新間隔: {settings['interval_minutes']} 分\n"
+            f"API予算の割合: {settings['api_share']:.0%} (1分あたり最大 {cap} / {HYPIXEL_API_BUDGET_PER_MINUTE} リクエスト)\n"
+            f"直近1分の使用量: このサーバー {api_budget.usage(interaction.guild.id)} / 全体 {api_budget.usage()}\n"
+            f"最終更新: {last_text}",
+            ephemeral=True
+        )
+
+    @app_commands.command(name="configure", description="このサーバーの更新間隔とAPI予算の割合を変更します。")
+    @app_commands.describe(interval_minutes="リーダーボードの更新間隔(分)", api_share="このサーバーが使えるAPI予算の割合 (0.01〜1.0)")
+    @app_commands.default_permissions(administrator=True)
+    async def configure(self, interaction: discord.Interaction,
+                        interval_minutes: Optional[app_commands.Range[int, 1, 1440]] = None,
+                        api_share: Optional[app_commands.Range[float, 0.01, 1.0]] = None):
+        values = {k: v for k, v in (('interval_minutes', interval_minutes), ('api_share', api_share)) if v is not None}
+        if not values:
+            return await interaction.response.send_message("エラー: 変更する項目を指定してください。", ephemeral=True)
+        guild_settings.update(interaction.guild.id, **values)
+        settings = guild_settings.get(interaction.guild.id)
+        await interaction.response.send_message(
+            f"成功: 更新間隔を {settings['interval_minutes']} 分、API予算の割合を {settings['api_share']:.0%} に設定しました。", ephemeral=True)
+
+    @app_commands.command(name="profile", description="次の自動更新サイクル1回分のプロファイル計測を予約・取り消します。")
+    @app_commands.default_permissions(administrator=True)
+    async def profile(self, interaction: discord.Interaction):
+        if cycle_profiler.running:
+            return await interaction.response.send_message("現在計測中です。完了後に `/admin getfile` で結果を取得できます。", ephemeral=True)
+        if cycle_profiler.toggle():
+            await interaction.response.send_message(
+                f"次の自動更新サイクルを計測します。完了後に `/admin getfile filename:{PROFILE_REPORT_FILE}` で結果を取得できます。", ephemeral=True)
+        else:
+            await interaction.response.send_message("プロファイル計測の予約を取り消しました。", ephemeral=True)
+
+    @app_commands.command(name="uploadfile", description="players.jsonをアップロードしてサーバーのデータを置き換えます。")
     @app_commands.describe(attachment="アップロードする players.json ファイル")
     @app_commands.default_permissions(administrator=True)
     async def uploadfile(self, interaction: discord.Interaction, attachment: discord.Attachment):
@@ -411,45 +1640,27 @@ class AdminGroup(app_commands.Group):
         if not attachment.filename.lower() == 'players.json':
             return await interaction.followup.send("エラー: ファイル名が `players.json` ではありません。", ephemeral=True)
         
-        if not attachment.content_type == 'application/json':
+        if not (attachment.content_type or '').startswith('application/json'):
             return await interaction.followup.send("エラー: ファイル形式がJSONではありません。", ephemeral=True)
 
-        try:
-            # 2. ファイルの内容を読み込み、JSONとして有効か検証
-            file_content = await attachment.read()
-            # bytesをstrにデコード
-            json_text = file_content.decode('utf-8')
-            # JSONとしてパースできるか試す
-            json.loads(json_text)
+        # 2. ストリーミングで読み込みながら検証し、UUIDの解決と差分の計算まで行う
+        async def report_progress(done: int, total: int):
+            try:
+                await interaction.edit_original_response(content=f"UUIDを解決しています... {done}/{total} 件")
+            except discord.HTTPException:
+                pass  # 進捗表示に失敗してもインポート自体は続ける
 
-        except json.JSONDecodeError:
-            return await interaction.followup.send("エラー: ファイルの内容が有効なJSON形式ではありません。", ephemeral=True)
+        try:
+            players_import = await read_players_import(attachment, on_progress=report_progress)
+        except ImportFormatError as e:
+            return await interaction.followup.send(f"エラー: ファイルの内容が不正です。{e}", ephemeral=True)
+        except UnicodeDecodeError:
+            return await interaction.followup.send("エラー: ファイルがUTF-8ではありません。", ephemeral=True)
         except Exception as e:
             return await interaction.followup.send(f"ファイルの読み込み中に予期せぬエラーが発生しました: {e}", ephemeral=True)
-            
-        try:
-            # 3. (推奨) 既存ファイルのバックアップ
-            if os.path.exists(PLAYERS_FILE):
-                os.rename(PLAYERS_FILE, PLAYERS_FILE + ".bak")
-                print(f"既存の {PLAYERS_FILE} をバックアップしました。")
-
-            # 4. 新しいファイルの内容で上書き
-            with open(PLAYERS_FILE, 'w', encoding='utf-8') as f:
-                f.write(json_text)
-            
-            await interaction.followup.send(
-                "`players.json` のアップロードと上書きに成功しました。\n"
-                "リーダーボードに反映させるには `/leaderboard refresh` を実行してください。",
-                ephemeral=True
-            )
-            print(f"管理者 {interaction.user} によって {PLAYERS_FILE} がアップロードされました。")
 
-        except Exception as e:
-            await interaction.followup.send(f"ファイルの上書き処理中にエラーが発生しました: {e}", ephemeral=True)
-            # エラーが起きた場合はバックアップを元に戻す試み
-            if os.path.exists(PLAYERS_FILE + ".bak"):
-                os.rename(PLAYERS_FILE + ".bak", PLAYERS_FILE)
-                print("エラーが発生したため、バックアップから復元しました。")
+        # 3. 内容を確認してもらい、「適用する」が押されたら反映する
+        await interaction.followup.send(players_import.summary(), view=ImportConfirmView(players_import, interaction.user), ephemeral=True)
 
 # --- コマンドをボットに登録 ---
 bot.tree.add_command(PlayerGroup())
@@ -481,10 +1692,24 @@ async def run_web_server():
 
 async def main():
     """ボットとWebサーバーの両方を並行して実行する"""
-    await asyncio.gather(
-        run_bot(),
-        run_web_server()
-    )
+    # Koyebの再デプロイ時はSIGTERMが送られるので、キャッシュを保存してから終了する
+    main_task = asyncio.current_task()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, main_task.cancel)
+    except NotImplementedError:
+        pass  # Windowsではシグナルハンドラを登録できない
+    try:
+        await asyncio.gather(
+            run_bot(),
+            run_web_server()
+        )
+    except asyncio.CancelledError:
+        print("終了シグナルを受け取りました。")
+    finally:
+        save_player_cache(force=True)
+        job_queue.flush_journal()
+        if not bot.is_closed():
+            await bot.close()
 
 if __name__ == "__main__":
     if DISCORD_TOKEN and HYPIXEL_API_KEY: